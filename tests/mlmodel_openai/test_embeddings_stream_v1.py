@@ -38,8 +38,8 @@ def test_openai_embedding_sync(set_trace_info, sync_openai_stream_client):
     with sync_openai_stream_client.embeddings.create(
         input="This is an embedding test.", model="text-embedding-ada-002"
     ) as response:
-        for resp in response.iter_lines():
-            assert resp
+        data = response.read()
+        assert data
 
 
 @SKIP_IF_NO_OPENAI_EMBEDDING_STREAMING_SUPPORT
@@ -56,17 +56,17 @@ def test_openai_embedding_async(loop, set_trace_info, async_openai_stream_client
         async with async_openai_stream_client.embeddings.create(
             input="This is an embedding test.", model="text-embedding-ada-002"
         ) as response:
-            async for resp in response.iter_lines():
-                assert resp
+            data = await response.aread()
+            assert data
 
     loop.run_until_complete(test())
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def sync_openai_stream_client(sync_openai_client, openai_version):
     return sync_openai_client.with_streaming_response
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def async_openai_stream_client(async_openai_client, openai_version):
     return async_openai_client.with_streaming_response
@@ -13,8 +13,11 @@
 # limitations under the License.
 
 import time
+from operator import itemgetter
 
-from newrelic.common.object_wrapper import function_wrapper, transient_function_wrapper
+from newrelic.common.object_wrapper import function_wrapper
+from newrelic.common.streaming_utils import StreamBuffer
+from newrelic.core.stats_engine import StatsEngine
 
 try:
     from newrelic.core.infinite_tracing_pb2 import AttributeValue, Span
@@ -63,58 +66,77 @@ def validate_span_events(
     if exact_intrinsics is None:
         exact_intrinsics = {}
 
+    # Attribute classes without any expectations always match.
+    check_intrinsics = bool(exact_intrinsics or expected_intrinsics or unexpected_intrinsics)
+    check_agents = bool(exact_agents or expected_agents or unexpected_agents)
+    check_users = bool(exact_users or expected_users or unexpected_users)
+
     @function_wrapper
     def _validate_wrapper(wrapped, instance, args, kwargs):
-        record_transaction_called = []
+        record_transaction_called = False
         recorded_span_events = []
 
-        @transient_function_wrapper("newrelic.core.stats_engine", "StatsEngine.record_transaction")
-        def capture_span_events(wrapped, instance, args, kwargs):
+        # Patch record_transaction directly for the duration of the call,
+        # binding the original so wrappers from outer validators still apply.
+        original_record_transaction = vars(StatsEngine)["record_transaction"]
+
+        def capture_span_events(self, *args, **kwargs):
+            nonlocal record_transaction_called
             events = []
+            original_put = vars(StreamBuffer)["put"]
 
-            @transient_function_wrapper("newrelic.common.streaming_utils", "StreamBuffer.put")
-            def stream_capture(wrapped, instance, args, kwargs):
-                event = args[0]
-                events.append(event)
-                return wrapped(*args, **kwargs)
+            def stream_capture(stream_buffer, item, *args, **kwargs):
+                events.append(item)
+                return original_put.__get__(stream_buffer, type(stream_buffer))(item, *args, **kwargs)
 
-            record_transaction_called.append(True)
+            record_transaction_called = True
+            StreamBuffer.put = stream_capture
             try:
-                result = stream_capture(wrapped)(*args, **kwargs)
+                result = original_record_transaction.__get__(self, type(self))(*args, **kwargs)
             except:
                 raise
             else:
-                if not instance.settings.infinite_tracing.enabled:
-                    events = [event for priority, seen_at, event in instance.span_events.pq]
+                if not self.settings.infinite_tracing.enabled:
+                    events = list(map(itemgetter(2), self.span_events.pq))
 
                 recorded_span_events.append(events)
+            finally:
+                StreamBuffer.put = original_put
 
             return result
 
-        _new_wrapper = capture_span_events(wrapped)
-        val = _new_wrapper(*args, **kwargs)
+        StatsEngine.record_transaction = capture_span_events
+        try:
+            val = wrapped(*args, **kwargs)
+        finally:
+            StatsEngine.record_transaction = original_record_transaction
+
         assert record_transaction_called
         captured_events = recorded_span_events.pop(index)
 
         mismatches = []
         matching_span_events = 0
-        for captured_event in captured_events:
-            if Span and isinstance(captured_event, Span):
-                intrinsics = captured_event.intrinsics
-                user_attrs = captured_event.user_attributes
-                agent_attrs = captured_event.agent_attributes
-            else:
-                intrinsics, user_attrs, agent_attrs = captured_event
 
-            _check_span_intrinsics(intrinsics)
+        # Events are either all protobuf spans (infinite tracing) or all
+        # (intrinsics, user_attrs, agent_attrs) tuples.
+        if Span and captured_events and isinstance(captured_events[0], Span):
+            span_attributes = map(_unpack_span, captured_events)
+        else:
+            span_attributes = captured_events
+
+        now_ms = int(time.time() * 1000)
+        for intrinsics, user_attrs, agent_attrs in span_attributes:
+            _check_span_intrinsics(intrinsics, now_ms)
 
-            intrinsics_ok = _check_span_attributes(
+            intrinsics_ok = not check_intrinsics or _check_span_attributes(
                 intrinsics, exact_intrinsics, expected_intrinsics, unexpected_intrinsics, mismatches
             )
-            agent_attr_ok = _check_span_attributes(
+            agent_attr_ok = not check_agents or _check_span_attributes(
                 agent_attrs, exact_agents, expected_agents, unexpected_agents, mismatches
             )
-            user_attr_ok = _check_span_attributes(user_attrs, exact_users, expected_users, unexpected_users, mismatches)
+            user_attr_ok = not check_users or _check_span_attributes(
+                user_attrs, exact_users, expected_users, unexpected_users, mismatches
+            )
 
             if intrinsics_ok and agent_attr_ok and user_attr_ok:
                 matching_span_events += 1
@@ -136,9 +158,13 @@ def validate_span_events(
     return _validate_wrapper
 
 
-def check_value_equals(dictionary, key, expected_value):
+def _unpack_span(span):
+    return span.intrinsics, span.user_attributes, span.agent_attributes
+
+
+def check_value_equals(dictionary, key, expected_value, _AttributeValue=AttributeValue):
     value = dictionary.get(key)
-    if AttributeValue and isinstance(value, AttributeValue):
+    if _AttributeValue and isinstance(value, _AttributeValue):
         for _, val in value.ListFields():
             if val != expected_value:
                 return False
@@ -164,25 +190,27 @@ def assert_isinstance(value, expected_type):
 
 
 def _check_span_attributes(attrs, exact, expected, unexpected, mismatches):
+    # Protobuf maps allocate on membership tests, so only collect their keys
+    # once. Plain dicts are tested directly.
+    keys = attrs if isinstance(attrs, dict) else frozenset(attrs)
+
     for expected_attribute in expected:
-        if expected_attribute not in attrs:
-            break
-    else:
-        for unexpected_attribute in unexpected:
-            if unexpected_attribute in attrs:
-                break
-        else:
-            for key, value in exact.items():
-                if not check_value_equals(attrs, key, value):
-                    mismatches.append(f"key: {key}, value:<{value}><{attrs.get(key)}>")
-                    break
-            else:
-                return True
+        if expected_attribute not in keys:
+            return False
+
+    for unexpected_attribute in unexpected:
+        if unexpected_attribute in keys:
+            return False
+
+    for key, value in exact.items():
+        if not check_value_equals(attrs, key, value):
+            mismatches.append(f"key: {key}, value:<{value}><{attrs.get(key)}>")
+            return False
 
-    return False
+    return True
 
 
-def _check_span_intrinsics(intrinsics):
+def _check_span_intrinsics(intrinsics, now_ms):
     assert check_value_equals(intrinsics, "type", "Span")
     assert_isinstance(intrinsics["traceId"], str)
     assert_isinstance(intrinsics["guid"], str)
@@ -195,7 +223,7 @@ def _check_span_intrinsics(intrinsics):
     ts = intrinsics["timestamp"]
     if AttributeValue and isinstance(ts, AttributeValue):
         ts = ts.double_value
-    assert ts <= int(time.time() * 1000)
+    assert ts <= now_ms
     assert_isinstance(intrinsics["duration"], float)
     assert_isinstance(intrinsics["name"], str)
     assert_isinstance(intrinsics["category"], str)
@@ -13,149 +13,196 @@
 # limitations under the License.
 
 import copy
+import functools
+from collections import namedtuple
 
-from newrelic.common.object_wrapper import function_wrapper, transient_function_wrapper
+from newrelic.common.object_wrapper import function_wrapper
+from newrelic.core.stats_engine import ApdexStats, StatsEngine
 from testing_support.fixtures import catch_background_exceptions
 
+# Immutable snapshot of the TimeStats/CountStats values held in the stats
+# tables. ApdexStats use different fields and are copied as is instead.
+_MetricSnap = namedtuple(
+    "_MetricSnap",
+    ["call_count", "total_call_time", "total_exclusive_call_time", "min_call_time", "max_call_time", "sum_of_squares"],
+)
 
-def validate_transaction_metrics(
-    name,
-    group="Function",
-    background_task=False,
-    scoped_metrics=None,
-    rollup_metrics=None,
-    custom_metrics=None,
-    dimensional_metrics=None,
-    index=-1,
-):
-    scoped_metrics = scoped_metrics or []
-    rollup_metrics = rollup_metrics or []
-    custom_metrics = custom_metrics or []
-    dimensional_metrics = dimensional_metrics or []
 
+def _snapshot_metric(stats):
+    if isinstance(stats, ApdexStats):
+        return copy.copy(stats)
+    return _MetricSnap._make(stats)
+
+
+@functools.lru_cache(maxsize=512)
+def _transaction_metric_names(name, group, background_task):
     if background_task:
-        unscoped_metrics = [
+        unscoped_metrics = (
             "OtherTransaction/all",
             f"OtherTransaction/{group}/{name}",
             "OtherTransactionTotalTime",
             f"OtherTransactionTotalTime/{group}/{name}",
-        ]
+        )
         transaction_scope_name = f"OtherTransaction/{group}/{name}"
     else:
-        unscoped_metrics = [
+        unscoped_metrics = (
             "WebTransaction",
             f"WebTransaction/{group}/{name}",
             "WebTransactionTotalTime",
             f"WebTransactionTotalTime/{group}/{name}",
             "HttpDispatcher",
-        ]
+        )
         transaction_scope_name = f"WebTransaction/{group}/{name}"
 
+    unscoped_keys = tuple(((unscoped_name, ""), 1) for unscoped_name in unscoped_metrics)
+    return unscoped_keys, transaction_scope_name
+
+
+def validate_transaction_metrics(
+    name,
+    group="Function",
+    background_task=False,
+    scoped_metrics=None,
+    rollup_metrics=None,
+    custom_metrics=None,
+    dimensional_metrics=None,
+    index=-1,
+):
+    scoped_metrics = scoped_metrics or []
+    rollup_metrics = rollup_metrics or []
+    custom_metrics = custom_metrics or []
+    # Tags are stored as frozensets in the dimensional stats table.
+    dimensional_metrics = tuple(
+        ((metric_name, frozenset(tags.items()) if isinstance(tags, dict) else tags), count)
+        for metric_name, tags, count in dimensional_metrics or ()
+    )
+
+    unscoped_keys, transaction_scope_name = _transaction_metric_names(name, group, background_task)
+
+    # Build the (name, scope) lookup keys up front so each validation run is
+    # only a series of dictionary lookups.
+    expected_metrics = (
+        unscoped_keys
+        + tuple(((scoped_name, transaction_scope_name), scoped_count) for scoped_name, scoped_count in scoped_metrics)
+        + tuple(((rollup_name, ""), rollup_count) for rollup_name, rollup_count in rollup_metrics)
+        + tuple(((custom_name, ""), custom_count) for custom_name, custom_count in custom_metrics)
+    )
+
+    custom_metric_names = {custom_name for custom_name, _ in custom_metrics}
+
     @function_wrapper
     def _validate_wrapper(wrapped, instance, args, kwargs):
-        record_transaction_called = []
+        record_transaction_called = False
         recorded_metrics = []
         recorded_dimensional_metrics = []
 
-        @transient_function_wrapper("newrelic.core.stats_engine", "StatsEngine.record_transaction")
+        # This must wrap each record_transaction call rather than the outer
+        # validator. The transaction may be recorded on a server thread, and
+        # raise_background_exceptions/wait_for_background_threads rely on the
+        # count and event being updated from that thread.
         @catch_background_exceptions
         def _validate_transaction_metrics(wrapped, instance, args, kwargs):
-            record_transaction_called.append(True)
+            nonlocal record_transaction_called
+            record_transaction_called = True
             try:
                 result = wrapped(*args, **kwargs)
             except:
                 raise
             else:
-                metrics = instance.stats_table
-                # Record a copy of the metric value so that the values aren't
-                # merged in the future
-                _metrics = {}
-                for k, v in metrics.items():
-                    _metrics[k] = copy.copy(v)
-                recorded_metrics.append(_metrics)
-
-                metrics = instance.dimensional_stats_table.metrics()
-                # Record a copy of the metric value so that the values aren't
-                # merged in the future
-                _metrics = {}
-                for k, v in metrics:
-                    _metrics[k] = copy.copy(v)
-                recorded_dimensional_metrics.append(_metrics)
+                # Record a snapshot of the metric values so that the values
+                # aren't merged in the future
+                recorded_metrics.append({k: _snapshot_metric(v) for k, v in instance.stats_table.items()})
+                if dimensional_metrics:
+                    recorded_dimensional_metrics.append(
+                        {
+                            k: {tags: _MetricSnap._make(v) for tags, v in container.items()}
+                            for k, container in instance.dimensional_stats_table.metrics()
+                        }
+                    )
+                else:
+                    recorded_dimensional_metrics.append({})
 
             return result
 
-        def _validate(metrics, name, scope, count):
-            key = (name, scope)
+        # Patch the class attribute directly for the duration of the call.
+        # Bind through the descriptor protocol so any wrapper already applied
+        # by an outer validator still receives the stats engine instance.
+        original_record_transaction = vars(StatsEngine)["record_transaction"]
 
-            if isinstance(scope, str):
-                # Normal metric lookup
-                metric = metrics.get(key)
-            else:
-                # Dimensional metric lookup
-                metric_container = metrics.get(name, {})
-                metric = metric_container.get(scope)
-
-            def _metrics_table():
-                out = [""]
-                out.append(f"Expected: {key}: {count}")
-                for metric_key, metric_container in metrics.items():
-                    if isinstance(metric_container, dict):
-                        for metric_tags, metric_value in metric_container.items():
-                            out.append(f"{metric_key, metric_tags}: {metric_value[0]}")
-                    else:
-                        out.append(f"{metric_key}: {metric_container[0]}")
-                return "\n".join(out)
-
-            def _metric_details():
-                return f"metric={key!r}, expected={count!r}, got={metric.call_count!r}"
-
-            if count is not None:
-                assert metric is not None, _metrics_table()
-                if count == "present":
-                    assert metric.call_count > 0, _metric_details()
-                else:
-                    assert metric.call_count == count, _metric_details()
+        def _record_transaction(self, *args, **kwargs):
+            return _validate_transaction_metrics(
+                original_record_transaction.__get__(self, type(self)), self, args, kwargs
+            )
 
-                assert metric.total_call_time >= 0, (key, metric)
-                assert metric.total_exclusive_call_time >= 0, (key, metric)
-                assert metric.min_call_time >= 0, (key, metric)
-                assert metric.sum_of_squares >= 0, (key, metric)
+        StatsEngine.record_transaction = _record_transaction
+        try:
+            val = wrapped(*args, **kwargs)
+        finally:
+            StatsEngine.record_transaction = original_record_transaction
 
-            else:
-                assert metric is None, _metrics_table()
-
-        _new_wrapper = _validate_transaction_metrics(wrapped)
-        val = _new_wrapper(*args, **kwargs)
         assert record_transaction_called
         metrics = recorded_metrics[index]
         captured_dimensional_metrics = recorded_dimensional_metrics[index]
 
-        record_transaction_called[:] = []
         recorded_metrics[:] = []
         recorded_dimensional_metrics[:] = []
 
-        for unscoped_metric in unscoped_metrics:
-            _validate(metrics, unscoped_metric, "", 1)
+        for key, count in expected_metrics:
+            _validate(metrics, key, count)
 
-        for scoped_name, scoped_count in scoped_metrics:
-            _validate(metrics, scoped_name, transaction_scope_name, scoped_count)
+        for key, count in dimensional_metrics:
+            _validate(captured_dimensional_metrics, key, count)
 
-        for rollup_name, rollup_count in rollup_metrics:
-            _validate(metrics, rollup_name, "", rollup_count)
+        unexpected_api_metric = next(
+            (name for name, _ in metrics if name.startswith("Supportability/api/") and name not in custom_metric_names),
+            None,
+        )
+        assert unexpected_api_metric is None, unexpected_api_metric
 
-        for custom_name, custom_count in custom_metrics:
-            _validate(metrics, custom_name, "", custom_count)
+        return val
 
-        for dimensional_name, dimensional_tags, dimensional_count in dimensional_metrics:
-            if isinstance(dimensional_tags, dict):
-                dimensional_tags = frozenset(dimensional_tags.items())
-            _validate(captured_dimensional_metrics, dimensional_name, dimensional_tags, dimensional_count)
+    return _validate_wrapper
 
-        custom_metric_names = {name for name, _ in custom_metrics}
-        for name, _ in metrics:
-            if name not in custom_metric_names:
-                assert not name.startswith("Supportability/api/"), name
 
-        return val
+def _validate(metrics, key, count):
+    name, scope = key
 
-    return _validate_wrapper
+    if isinstance(scope, str):
+        # Normal metric lookup
+        metric = metrics.get(key)
+    else:
+        # Dimensional metric lookup
+        metric_container = metrics.get(name, {})
+        metric = metric_container.get(scope)
+
+    # Failure messages are only built when an assertion trips.
+    if count is not None:
+        assert metric is not None, _metrics_table(metrics, key, count)
+        if count == "present":
+            assert metric.call_count > 0, _metric_details(key, count, metric)
+        else:
+            assert metric.call_count == count, _metric_details(key, count, metric)
+
+        assert metric.total_call_time >= 0, (key, metric)
+        assert metric.total_exclusive_call_time >= 0, (key, metric)
+        assert metric.min_call_time >= 0, (key, metric)
+        assert metric.sum_of_squares >= 0, (key, metric)
+
+    else:
+        assert metric is None, _metrics_table(metrics, key, count)
+
+
+def _metrics_table(metrics, key, count):
+    out = [""]
+    out.append(f"Expected: {key}: {count}")
+    for metric_key, metric_container in metrics.items():
+        if isinstance(metric_container, dict):
+            for metric_tags, metric_value in metric_container.items():
+                out.append(f"{metric_key, metric_tags}: {metric_value[0]}")
+        else:
+            out.append(f"{metric_key}: {metric_container[0]}")
+    return "\n".join(out)
+
+
+def _metric_details(key, count, metric):
+    return f"metric={key!r}, expected={count!r}, got={metric.call_count!r}"